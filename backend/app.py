@@ -1,23 +1,36 @@
 # backend/app.py - SmartTransit Backend API
-import os, math, json, hashlib, secrets, uuid
+import os, re, sys, math, time, asyncio, hashlib, secrets, uuid, difflib, heapq, logging, sqlite3
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
-import urllib.request
-from datetime import datetime, timedelta
-from typing import Optional, List
-
-from fastapi import FastAPI, HTTPException, Depends, Query
+import httpx
+from datetime import datetime
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from typing import Optional, List, Tuple, FrozenSet, NamedTuple
+
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 import joblib
+import numpy as np
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from sklearn.neighbors import BallTree
+
+logger = logging.getLogger(__name__)
 
 # ── SQLite + SQLAlchemy ──────────────────────────────────────────────
-from sqlalchemy import create_engine, Column, String, Float, Integer, Boolean, DateTime, Text
+from sqlalchemy import create_engine, event, func, case, or_, select, delete, exists, table, column, literal_column, bindparam, lambda_stmt, Index, Column, String, Float, Integer, Boolean, DateTime, Text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, Session, load_only
+from sqlalchemy.pool import QueuePool
 
 # Use an absolute path so the app always hits the same SQLite file, no matter
 # where Uvicorn is launched from (root vs backend folder).
@@ -25,7 +38,32 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_PATH = os.path.join(BASE_DIR, 'smarttransit.db')
 DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
 print(f"DEBUG: Using database at: {DATABASE_PATH}")
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# SQLAlchemy 1.4 defaults file-based SQLite to NullPool, which reopens the
+# file and re-runs the pragmas below for every session. Keep a pool instead,
+# able to hand one connection to each of AnyIO's 40 default threadpool
+# workers, so sync endpoints never wait on a checkout; connections are local,
+# so no pre-ping or recycling.
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=10,
+    max_overflow=30,
+    pool_recycle=-1,
+)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _):
+    # WAL lets readers run alongside the single writer, and NORMAL sync skips
+    # the fsync on every commit (still durable across app crashes).
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -45,41 +83,100 @@ def _b64(data: bytes) -> str:
     return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
 
 def _b64d(s: str) -> bytes:
-    s += "=" * (4 - len(s) % 4)
-    return base64.urlsafe_b64decode(s)
+    # Strict: stray characters must fail rather than be silently skipped
+    s += "=" * (-len(s) % 4)
+    return base64.b64decode(s, altchars=b"-_", validate=True)
+
+_JWT_KEY = JWT_SECRET.encode()
+# The one unpadded base64url spelling of a 32-byte HMAC-SHA256: the last
+# character carries 2 padding bits, which must be zero. b64decode alone also
+# takes "+/" and nonzero padding bits, giving one token many valid spellings.
+_JWT_SIG_RE = re.compile(r"[A-Za-z0-9_-]{42}[AEIMQUYcgkosw048]")
+_JWT_HEADER = _b64(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+
+def _jwt_sign(header: str, body: str) -> bytes:
+    return hmac.new(_JWT_KEY, f"{header}.{body}".encode(), hashlib.sha256).digest()
 
 def create_token(payload: dict) -> str:
-    header = _b64(json.dumps({"alg": "HS256", "typ": "JWT"}).encode())
-    payload["exp"] = (datetime.utcnow() + timedelta(hours=JWT_EXPIRY_HOURS)).isoformat()
-    body = _b64(json.dumps(payload).encode())
-    sig = _b64(hmac.new(JWT_SECRET.encode(), f"{header}.{body}".encode(), hashlib.sha256).digest())
+    header = _JWT_HEADER
+    payload["exp"] = int(time.time()) + JWT_EXPIRY_HOURS * 3600
+    body = _b64(orjson.dumps(payload))
+    sig = _b64(_jwt_sign(header, body))
     return f"{header}.{body}.{sig}"
 
+@lru_cache(maxsize=4096)
+def _verify_token(token: str) -> dict:
+    """Check the signature and parse the payload; cached per token so repeat
+    requests carrying the same bearer token skip the HMAC and JSON work."""
+    parts = token.split(".")
+    if len(parts) != 3:
+        raise ValueError("bad token")
+    header, body, sig = parts
+    if not _JWT_SIG_RE.fullmatch(sig):
+        raise ValueError("non-canonical signature")
+    # Compare raw digests rather than re-encoding the expected one
+    if not hmac.compare_digest(_b64d(sig), _jwt_sign(header, body)):
+        raise ValueError("invalid signature")
+    return orjson.loads(_b64d(body))
+
 def decode_token(token: str) -> dict:
     try:
-        parts = token.split(".")
-        if len(parts) != 3:
-            raise ValueError("bad token")
-        header, body, sig = parts
-        expected_sig = _b64(hmac.new(JWT_SECRET.encode(), f"{header}.{body}".encode(), hashlib.sha256).digest())
-        if not hmac.compare_digest(sig, expected_sig):
-            raise ValueError("invalid signature")
-        payload = json.loads(_b64d(body))
-        if datetime.fromisoformat(payload["exp"]) < datetime.utcnow():
+        payload = _verify_token(token)
+        # Tokens issued before exp became epoch seconds fail here and re-login
+        if payload["exp"] < time.time():
             raise ValueError("expired")
         return payload
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
+# New hashes use Argon2id; "salt:hex" PBKDF2 hashes from older accounts are
+# still accepted and upgraded on the next successful login. Parameters are
+# OWASP's Argon2id minimum (19 MiB, 2 passes, 1 lane): about 23 ms per hash,
+# where argon2-cffi's defaults take ~190 ms and reserve 64 MiB per call.
+# Hashes made with other parameters are rehashed on login.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 def hash_password(password: str) -> str:
-    salt = secrets.token_hex(16)
-    h = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), 100000)
-    return f"{salt}:{h.hex()}"
+    return password_hasher.hash(password)
 
 def verify_password(password: str, stored: str) -> bool:
+    if stored.startswith("$argon2"):
+        try:
+            return password_hasher.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    if ":" not in stored:
+        return False  # e.g. GOOGLE_OAUTH accounts have no password
     salt, h = stored.split(":")
     return hmac.compare_digest(h, hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), 100000).hex())
 
+def password_needs_rehash(stored: str) -> bool:
+    return not stored.startswith("$argon2") or password_hasher.check_needs_rehash(stored)
+
+# Recently verified logins: email -> (expires_at, password_hash, keyed digest of
+# the password). A client logging in again within the TTL skips the KDF; the
+# entry is ignored as soon as the stored hash changes.
+LOGIN_CACHE_TTL = 60
+LOGIN_CACHE_MAX = 10000
+_LOGIN_CACHE_KEY = secrets.token_bytes(32)
+_login_cache = {}
+
+def verify_login(email: str, password: str, stored: str) -> bool:
+    digest = hmac.new(_LOGIN_CACHE_KEY, password.encode(), hashlib.sha256).digest()
+    now = time.monotonic()
+    hit = _login_cache.get(email)
+    if hit and hit[0] > now and hit[1] == stored and hmac.compare_digest(hit[2], digest):
+        return True
+    if not verify_password(password, stored):
+        return False
+    if len(_login_cache) >= LOGIN_CACHE_MAX:
+        for key in [k for k, v in _login_cache.items() if v[0] <= now]:
+            _login_cache.pop(key, None)
+        if len(_login_cache) >= LOGIN_CACHE_MAX:
+            _login_cache.clear()
+    _login_cache[email] = (now + LOGIN_CACHE_TTL, stored, digest)
+    return True
+
 # ── Database Models ──────────────────────────────────────────────────
 class UserDB(Base):
     __tablename__ = "users"
@@ -104,6 +201,8 @@ class TicketDB(Base):
     status = Column(String, default="active")  # active, used, expired
     booked_at = Column(DateTime, default=datetime.utcnow)
     qr_data = Column(String, default="")
+    # Serves "my tickets, newest first" as a single index range scan
+    __table_args__ = (Index("ix_tickets_user_booked", "user_id", "booked_at"),)
 
 class SavedRouteDB(Base):
     __tablename__ = "saved_routes"
@@ -113,6 +212,7 @@ class SavedRouteDB(Base):
     from_place = Column(String, nullable=False)
     to_place = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index("ix_saved_routes_user_created", "user_id", "created_at"),)
 
 class LiveBusDB(Base):
     __tablename__ = "live_buses"
@@ -129,8 +229,103 @@ class LiveBusDB(Base):
     delay_reason = Column(String, default="")
     trip_started_at = Column(DateTime, default=datetime.utcnow)
     last_update = Column(DateTime, default=datetime.utcnow)
+    # When the GPS ping the position came from was received. Only the ping
+    # upsert writes it, so other updates can't make a buffered ping look stale.
+    position_at = Column(DateTime)
+    # A route's buses in bus_reg order (smart-eta) as one index range scan
+    __table_args__ = (Index("ix_live_buses_route_bus", "route_id", "bus_reg"),)
+
+class EndedTripDB(Base):
+    """When each bus last ended a trip, so pings buffered by any worker before
+    that moment can't put the bus back on the live map."""
+    __tablename__ = "ended_trips"
+    bus_reg = Column(String, primary_key=True)
+    ended_at = Column(DateTime, default=datetime.utcnow)
 
 Base.metadata.create_all(bind=engine)
+# create_all leaves existing tables alone, so add indexes introduced since
+# the database was first created
+for _table in Base.metadata.sorted_tables:
+    for _index in _table.indexes:
+        _index.create(bind=engine, checkfirst=True)
+
+def _add_position_at():
+    """live_buses.position_at arrived after the table; add it to older files."""
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        if "position_at" not in {row[1] for row in cur.execute("PRAGMA table_info(live_buses)")}:
+            try:
+                cur.execute("ALTER TABLE live_buses ADD COLUMN position_at DATETIME")
+            except sqlite3.OperationalError:  # another worker added it first
+                pass
+        cur.close()
+    finally:
+        conn.close()
+
+_add_position_at()
+
+# R*Tree over live bus positions, kept in step with live_buses by triggers, so
+# nearest-bus lookups can read a bounding box instead of every bus on a route.
+_LIVE_RTREE_TRIGGERS = ("live_buses_rtree_ins", "live_buses_rtree_upd", "live_buses_rtree_del")
+_LIVE_RTREE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS live_buses_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng)",
+    "CREATE TRIGGER IF NOT EXISTS live_buses_rtree_ins AFTER INSERT ON live_buses BEGIN "
+    "INSERT INTO live_buses_rtree VALUES (new.rowid, new.latitude, new.latitude, new.longitude, new.longitude); END",
+    "CREATE TRIGGER IF NOT EXISTS live_buses_rtree_upd AFTER UPDATE OF latitude, longitude ON live_buses BEGIN "
+    "UPDATE live_buses_rtree SET min_lat = new.latitude, max_lat = new.latitude, "
+    "min_lng = new.longitude, max_lng = new.longitude WHERE id = new.rowid; END",
+    "CREATE TRIGGER IF NOT EXISTS live_buses_rtree_del AFTER DELETE ON live_buses BEGIN "
+    "DELETE FROM live_buses_rtree WHERE id = old.rowid; END",
+)
+# Entries are keyed by live_buses.rowid, which VACUUM may renumber for a
+# text-keyed table, and a build without R*Tree support writes live_buses with
+# the triggers dropped; either way some bus no longer sits inside its entry.
+# The R*Tree stores float32 boxes rounded outwards, so containment is exact.
+_LIVE_RTREE_STALE = (
+    "SELECT (SELECT count(*) FROM live_buses) != (SELECT count(*) FROM live_buses_rtree) "
+    "OR EXISTS (SELECT 1 FROM live_buses b LEFT JOIN live_buses_rtree r ON r.id = b.rowid "
+    "WHERE r.id IS NULL OR b.latitude NOT BETWEEN r.min_lat AND r.max_lat "
+    "OR b.longitude NOT BETWEEN r.min_lng AND r.max_lng)"
+)
+_LIVE_RTREE_REBUILD = (
+    "DELETE FROM live_buses_rtree",
+    "INSERT INTO live_buses_rtree SELECT rowid, latitude, latitude, longitude, longitude FROM live_buses",
+)
+live_buses_rtree = table("live_buses_rtree", column("id"), column("min_lat"), column("max_lat"), column("min_lng"), column("max_lng"))
+
+def _rtree_available() -> bool:
+    probe = sqlite3.connect(":memory:")
+    try:
+        probe.execute("CREATE VIRTUAL TABLE t USING rtree(id, min_x, max_x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        probe.close()
+
+def _create_live_rtree() -> bool:
+    """Set up the R*Tree and its triggers if missing, and rebuild it only when
+    it is out of step, so workers starting together just read."""
+    with engine.connect() as conn:
+        present = {name for (name,) in conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE 'live_buses_rtree%'")}
+    if not _rtree_available():
+        # Triggers left by a build with R*Tree would fail every live_buses write
+        with engine.begin() as conn:
+            for trigger in present.intersection(_LIVE_RTREE_TRIGGERS):
+                conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+        return False
+    with engine.begin() as conn:
+        if not present.issuperset(("live_buses_rtree",) + _LIVE_RTREE_TRIGGERS):
+            for ddl in _LIVE_RTREE_DDL:
+                conn.exec_driver_sql(ddl)
+        if conn.exec_driver_sql(_LIVE_RTREE_STALE).scalar():
+            for ddl in _LIVE_RTREE_REBUILD:
+                conn.exec_driver_sql(ddl)
+    return True
+
+LIVE_RTREE = _create_live_rtree()
 
 # ── Dependency ──────────────────────────────────────────────────────
 def get_db():
@@ -150,10 +345,46 @@ def get_current_user(token: str = Query(None, alias="token"), authorization: str
 
 # ── Load ML model ───────────────────────────────────────────────────
 model_path = os.path.join(os.path.dirname(__file__), "model.pkl")
-try:
-    eta_model = joblib.load(model_path)
-except Exception:
-    eta_model = None
+
+class ForestETA:
+    """predict() for a fitted single-output sklearn forest, in plain Python.
+    A request predicts one or two rows, and walking a couple dozen shallow
+    trees costs microseconds where sklearn's per-call validation and dispatch
+    cost milliseconds."""
+
+    def __init__(self, model):
+        self.trees = [
+            (t.feature.tolist(), t.threshold.tolist(), t.children_left.tolist(),
+             t.children_right.tolist(), t.value[:, 0, 0].tolist())
+            for t in (est.tree_ for est in model.estimators_)
+        ]
+
+    def predict(self, rows) -> List[float]:
+        # sklearn trees compare float32 inputs against their thresholds
+        out = []
+        for row in np.asarray(rows, dtype=np.float32).tolist():
+            total = 0.0
+            for feature, threshold, left, right, value in self.trees:
+                node = 0
+                while left[node] != -1:
+                    node = left[node] if row[feature[node]] <= threshold[node] else right[node]
+                total += value[node]
+            out.append(total / len(self.trees))
+        return out
+
+def _load_eta_model():
+    """Random forests are served through ForestETA; anything else is used as
+    loaded. None when model.pkl is missing or unreadable."""
+    try:
+        model = joblib.load(model_path)
+    except Exception:
+        return None
+    from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
+    if isinstance(model, (RandomForestRegressor, ExtraTreesRegressor)) and model.n_outputs_ == 1:
+        return ForestETA(model)
+    return model
+
+eta_model = _load_eta_model()
 
 # ── Pydantic Schemas ────────────────────────────────────────────────
 class RegisterRequest(BaseModel):
@@ -318,8 +549,150 @@ BUS_STOPS = [
     {"id": "rbs", "name": "Rabindra Sadan", "lat": 22.5310, "lng": 88.3470, "routes": ["12B","34","AC36"]},
 ]
 
+# ── Lookup indexes ───────────────────────────────────────────────────
+# BUS_ROUTES / BUS_STOPS never change at runtime, so build the lookups once
+# instead of scanning the lists on every request. The route/stop dicts stay
+# the API payloads; stop lookups below hold read-only Stop records instead,
+# with routes frozen and pos = index into BUS_STOPS.
+class Stop(NamedTuple):
+    pos: int
+    id: str
+    name: str
+    lat: float
+    lng: float
+    routes: FrozenSet[str]
+
+_STOPS = tuple(Stop(i, s["id"], s["name"], s["lat"], s["lng"], frozenset(s["routes"])) for i, s in enumerate(BUS_STOPS))
+_ROUTES_BY_ID = {r["id"]: r for r in BUS_ROUTES}
+# route id -> (route_name, route_info) as shown next to each live bus
+_ROUTE_LABELS = {r["id"]: (r["name"], f"{r['from']} → {r['to']}") for r in BUS_ROUTES}
+_STOPS_BY_ID = {s.id: s for s in _STOPS}
+_STOPS_BY_NAME = {s.name.lower(): s for s in _STOPS}
+# Bipartite route <-> stop graph for transfer search
+_ROUTE_STOPS = {r["id"]: tuple(s for s in _STOPS if r["id"] in s.routes) for r in BUS_ROUTES}
+
+def _build_route_adjacency():
+    """(route_a, route_b) -> BUS_STOPS positions of the stops served by both,
+    in list order, for every pair of routes that meet (including a == b)."""
+    table = {}
+    for s in _STOPS:
+        for a in s.routes:
+            for b in s.routes:
+                table.setdefault((a, b), []).append(s.pos)
+    return {pair: tuple(positions) for pair, positions in table.items()}
+
+# Route graph for one-transfer trips: a dict probe per route pair instead of
+# walking every stop reachable from either end
+_ROUTE_ADJ = _build_route_adjacency()
+# (lat, lng) per stop, row-aligned with BUS_STOPS, for vectorized distances
+_STOP_LATLNG = np.array([(s.lat, s.lng) for s in _STOPS], dtype=np.float64)
+# Straight-line km between every pair of stops (N x N, ~50 KB), so route
+# queries only index into it instead of redoing the math per request
+_STOP_DIST_KM = np.sqrt(((_STOP_LATLNG[:, None, :] - _STOP_LATLNG[None, :, :]) ** 2).sum(axis=2)) * 111
+
+def _build_direct_routes():
+    """(from_pos, to_pos) -> ((route, est_time_min, est_fare), ...) for every
+    stop pair sharing a route, in route id order."""
+    table = {}
+    for rid in sorted(_ROUTE_STOPS):
+        route = _ROUTES_BY_ID[rid]
+        for a in _ROUTE_STOPS[rid]:
+            for b in _ROUTE_STOPS[rid]:
+                est_time = max(5, int(_STOP_DIST_KM[a.pos, b.pos] * 3.5))
+                table.setdefault((a.pos, b.pos), []).append((route, est_time, route.get("fare_min", 8)))
+    return {pair: tuple(options) for pair, options in table.items()}
+
+_DIRECT_ROUTES = _build_direct_routes()
+
+EARTH_RADIUS_KM = 6371
+
+def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle km between two points given in degrees."""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+def haversine_vec(lat: float, lng: float, lats_rad: np.ndarray, lngs_rad: np.ndarray,
+                  cos_lats: Optional[np.ndarray] = None) -> np.ndarray:
+    """Great-circle km from (lat, lng) in degrees to every point of the radian
+    arrays. Pass cos_lats = np.cos(lats_rad) when it is already known."""
+    lat_rad, lng_rad = math.radians(lat), math.radians(lng)
+    if cos_lats is None:
+        cos_lats = np.cos(lats_rad)
+    a = np.sin((lats_rad - lat_rad) / 2) ** 2 + math.cos(lat_rad) * cos_lats * np.sin((lngs_rad - lng_rad) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+# Stop (lat, lng) in radians, row-aligned with BUS_STOPS, for the tree below
+# and for the distances reported to clients. cos(lat) is the only per-point
+# trig term in haversine that doesn't depend on the query point, so it is
+# computed once per stop.
+_STOP_LATLNG_RAD = np.radians(_STOP_LATLNG)
+_STOP_LATLNG_COS = np.cos(_STOP_LATLNG_RAD[:, 0])
+# Ball tree over stop coordinates in radians: nearest-stop queries walk the
+# tree in compiled code instead of computing haversine to every stop.
+_STOP_TREE = BallTree(_STOP_LATLNG_RAD, metric="haversine", leaf_size=16)
+
+def _nearest_stops(lat: float, lng: float, k: int) -> List[Tuple[Stop, float]]:
+    """[(stop, distance_km), ...] for the k stops closest to (lat, lng), nearest
+    first. k must be between 1 and len(_STOPS)."""
+    dists, idx = _STOP_TREE.query(np.radians([[lat, lng]]), k=k)
+    return [(_STOPS[i], d * EARTH_RADIUS_KM) for i, d in zip(idx[0].tolist(), dists[0].tolist())]
+
+# Lowercased names row-aligned with BUS_STOPS
+_STOP_NAMES_IN_ORDER = tuple(s.name.lower() for s in _STOPS)
+# Shortest names first, so the first substring hit is the tightest match
+_STOP_NAME_LOWER = tuple(sorted(((s.name.lower(), s) for s in _STOPS), key=lambda x: len(x[0])))
+# The same names joined with NULs: one C-level str.find over this blob does
+# the whole substring search, and bisecting the start offsets maps a hit back
+# to its stop.
+_STOP_NAME_BLOB = "\0".join(name for name, _ in _STOP_NAME_LOWER)
+_STOP_NAME_STARTS = tuple(accumulate((len(name) + 1 for name, _ in _STOP_NAME_LOWER[:-1]), initial=0))
+
+# Common aliases for Kolkata places
+_STOP_ALIASES = {
+    "howrah": "howrah station", "sealdah": "sealdah station",
+    "newtown": "new town city centre", "new town": "new town city centre",
+    "airport": "airport (nscbi)", "garia": "garia station",
+    "salt lake": "salt lake sector v", "sector v": "salt lake sector v",
+    "sector 5": "salt lake sector v", "sector i": "salt lake sector i",
+    "sector 1": "salt lake sector i", "dum dum": "dum dum",
+    "tollygunge": "tollygunge", "tolly": "tollygunge",
+    "karunamoyee": "karunamoyee", "ruby": "ruby hospital",
+    "esplanade": "esplanade", "jadavpur": "jadavpur",
+    "barasat": "barasat", "behala": "behala", "joka": "joka",
+    "bbdbagh": "bbd bagh", "bbd bagh": "bbd bagh",
+    "gariahat": "gariahat", "park circus": "park circus",
+    "science city": "science city", "dunlop": "dunlop",
+    "nicco park": "nicco park", "babughat": "babughat",
+    "shyambazar": "shyambazar", "barrackpore": "barrackpore",
+    "belur": "belur math", "belur math": "belur math",
+    "dakshineswar": "dakshineswar", "sovabazar": "sovabazar",
+    "bhawanipur": "bhawanipur", "hazra": "hazra",
+    "lansdowne": "lansdowne", "ballygunge": "ballygunge",
+    "kasba": "kasba", "regent park": "regent park",
+    "maniktala": "maniktala", "belgachia": "belgachia",
+    "cossipore": "cossipore", "sodepur": "sodepur",
+    "naihati": "naihati", "chandannagar": "chandannagar",
+    "bally": "bally", "liluah": "liluah",
+    "belgharia": "belgharia", "madhyamgram": "madhyamgram",
+    "rajarhat": "rajarhat", "chinar park": "chinar park",
+    "baguiati": "baguiati", "phoolbagan": "phoolbagan",
+    "entally": "entally", "dharmatala": "dharmatala",
+    "maidan": "maidan", "nandan": "nandan",
+    "exide": "exide crossing", "rabindra sadan": "rabindra sadan",
+}
+# Candidates for typo-tolerant matching when nothing else hits
+_STOP_FUZZY_KEYS = list(_STOPS_BY_NAME) + [a for a in _STOP_ALIASES if a not in _STOPS_BY_NAME]
+
+# Lowercased name/from/to/via per route for /routes/search, NUL-separated so a
+# query can only match inside a single field
+_ROUTE_SEARCH_BLOBS = tuple(
+    (r, "\0".join((r["name"], r["from"], r["to"], r.get("via", ""))).lower()) for r in BUS_ROUTES
+)
+
 # ── App Init ─────────────────────────────────────────────────────────
-app = FastAPI(title="SmartTransit API", version="2.0.0")
+app = FastAPI(title="SmartTransit API", version="2.0.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -329,52 +702,98 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ── Static responses ────────────────────────────────────────────────
+# Payloads that never change while the process runs are encoded once, and
+# served with an ETag so browsers and proxies can revalidate for free.
+STATIC_MAX_AGE = 300
+# One entity-tag from an If-None-Match list (RFC 9110 8.8.3); tags may contain
+# commas, so the header is tokenized rather than split
+_ETAG_RE = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match check: "*" or any listed tag equal to etag under weak
+    comparison, i.e. ignoring W/ prefixes."""
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in _ETAG_RE.findall(if_none_match):
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+class StaticJSON:
+    def __init__(self, content):
+        self.body = orjson.dumps(content)
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+
+    def response(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": f"public, max-age={STATIC_MAX_AGE}"}
+        if etag_matches(request.headers.get("if-none-match", ""), self.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+_CONFIG_JSON = StaticJSON({
+    "google_client_id": GOOGLE_CLIENT_ID,
+    "ors_key": ORS_KEY,
+    "gemini_key": GEMINI_KEY
+})
+_ROUTES_JSON = StaticJSON({"routes": BUS_ROUTES})
+
 # ── Root ─────────────────────────────────────────────────────────────
 @app.get("/")
 def root():
     return {"message": "SmartTransit API v2.0 🚍", "status": "running"}
 
 @app.get("/config")
-def get_config():
+def get_config(request: Request):
     """Provides public API keys to the frontend."""
-    return {
-        "google_client_id": GOOGLE_CLIENT_ID,
-        "ors_key": ORS_KEY,
-        "gemini_key": GEMINI_KEY
-    }
+    return _CONFIG_JSON.response(request)
 
 # ── Auth ─────────────────────────────────────────────────────────────
+def _register_user(req: RegisterRequest, db: Session) -> UserDB:
+    existing = db.query(UserDB).filter(UserDB.email == req.email).first()
+    if existing:
+        print(f"DEBUG: Email {req.email} already exists.")
+        raise HTTPException(status_code=400, detail="Email already registered")
+    user = UserDB(
+        name=req.name,
+        email=req.email,
+        password_hash=hash_password(req.password),
+        role=req.role,
+        phone=req.phone,
+        employee_id=req.employee_id,
+    )
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    return user
+
 @app.post("/auth/register")
-def register(req: RegisterRequest, db: Session = Depends(get_db)):
+async def register(req: RegisterRequest, db: Session = Depends(get_db)):
     print(f"DEBUG: Registering user {req.email}")
     try:
-        existing = db.query(UserDB).filter(UserDB.email == req.email).first()
-        if existing:
-            print(f"DEBUG: Email {req.email} already exists.")
-            raise HTTPException(status_code=400, detail="Email already registered")
-        user = UserDB(
-            name=req.name,
-            email=req.email,
-            password_hash=hash_password(req.password),
-            role=req.role,
-            phone=req.phone,
-            employee_id=req.employee_id,
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
+        # Argon2 + SQLite are blocking; keep them off the event loop.
+        user = await run_in_threadpool(_register_user, req, db)
         print(f"DEBUG: User {req.email} registered successfully with ID {user.id}")
         token = create_token({"user_id": user.id, "email": user.email, "role": user.role, "name": user.name})
         return {"token": token, "user": {"id": user.id, "name": user.name, "email": user.email, "role": user.role}}
     except Exception as e:
         print(f"DEBUG: Registration ERROR: {str(e)}")
-        db.rollback()
+        await run_in_threadpool(db.rollback)
         raise e
 
-@app.post("/auth/login")
-def login(req: LoginRequest, db: Session = Depends(get_db)):
+def _authenticate(req: LoginRequest, db: Session) -> Optional[UserDB]:
     user = db.query(UserDB).filter(UserDB.email == req.email).first()
-    if not user or not verify_password(req.password, user.password_hash):
+    if not user or not verify_login(user.email, req.password, user.password_hash):
+        return None
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = hash_password(req.password)
+        db.commit()
+        db.refresh(user)
+    return user
+
+@app.post("/auth/login")
+async def login(req: LoginRequest, db: Session = Depends(get_db)):
+    user = await run_in_threadpool(_authenticate, req, db)
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     token = create_token({"user_id": user.id, "email": user.email, "role": user.role, "name": user.name})
     return {"token": token, "user": {"id": user.id, "name": user.name, "email": user.email, "role": user.role}}
@@ -383,14 +802,37 @@ class GoogleAuthRequest(BaseModel):
     credential: str
     role: str = "passenger"
 
+# Shared client so Google sign-ins reuse pooled keep-alive (HTTP/2)
+# connections instead of paying a TCP+TLS handshake on every request.
+google_http = httpx.AsyncClient(timeout=3, http2=True, limits=httpx.Limits(max_keepalive_connections=20))
+
+@app.on_event("shutdown")
+async def close_google_http():
+    await google_http.aclose()
+
+def _get_or_create_google_user(email: str, name: str, role: str, db: Session) -> UserDB:
+    user = db.query(UserDB).filter(UserDB.email == email).first()
+    if not user:
+        # Auto-register with Google OAuth marker
+        user = UserDB(
+            name=name,
+            email=email,
+            password_hash="GOOGLE_OAUTH",
+            role=role,
+        )
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+    return user
+
 @app.post("/auth/google")
-def google_auth(req: GoogleAuthRequest, db: Session = Depends(get_db)):
+async def google_auth(req: GoogleAuthRequest, db: Session = Depends(get_db)):
     """Verify Google ID token and login/register the user."""
     try:
         # Verify token with Google
-        url = f"https://oauth2.googleapis.com/tokeninfo?id_token={req.credential}"
-        with urllib.request.urlopen(url) as resp:
-            info = json.loads(resp.read().decode())
+        resp = await google_http.get("https://oauth2.googleapis.com/tokeninfo", params={"id_token": req.credential})
+        resp.raise_for_status()
+        info = orjson.loads(resp.content)
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid Google token")
 
@@ -404,94 +846,49 @@ def google_auth(req: GoogleAuthRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="No email in Google token")
 
     # Check if user exists
-    user = db.query(UserDB).filter(UserDB.email == email).first()
-    if not user:
-        # Auto-register with Google OAuth marker
-        user = UserDB(
-            name=name,
-            email=email,
-            password_hash="GOOGLE_OAUTH",
-            role=req.role,
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
+    user = await run_in_threadpool(_get_or_create_google_user, email, name, req.role, db)
 
     token = create_token({"user_id": user.id, "email": user.email, "role": user.role, "name": user.name})
     return {"token": token, "user": {"id": user.id, "name": user.name, "email": user.email, "role": user.role}}
 
 # ── Bus Routes ───────────────────────────────────────────────────────
 @app.get("/routes")
-def get_routes():
-    return {"routes": BUS_ROUTES}
+def get_routes(request: Request):
+    return _ROUTES_JSON.response(request)
 
 # NOTE: find-route and search MUST come before {route_id} wildcard
 
 def _match_stop(query: str):
-    """Fuzzy match a stop by name: supports partial, word-boundary, and alias matching."""
+    """Fuzzy match a stop by name: supports partial, word-boundary, alias and typo matching."""
     q = query.lower().strip()
     # Exact match first
-    for s in BUS_STOPS:
-        if s["name"].lower() == q or s["id"] == q:
-            return s
-    # Common aliases for Kolkata places
-    aliases = {
-        "howrah": "howrah station", "sealdah": "sealdah station",
-        "newtown": "new town city centre", "new town": "new town city centre",
-        "airport": "airport (nscbi)", "garia": "garia station",
-        "salt lake": "salt lake sector v", "sector v": "salt lake sector v",
-        "sector 5": "salt lake sector v", "sector i": "salt lake sector i",
-        "sector 1": "salt lake sector i", "dum dum": "dum dum",
-        "tollygunge": "tollygunge", "tolly": "tollygunge",
-        "karunamoyee": "karunamoyee", "ruby": "ruby hospital",
-        "esplanade": "esplanade", "jadavpur": "jadavpur",
-        "barasat": "barasat", "behala": "behala", "joka": "joka",
-        "bbdbagh": "bbd bagh", "bbd bagh": "bbd bagh",
-        "gariahat": "gariahat", "park circus": "park circus",
-        "science city": "science city", "dunlop": "dunlop", 
-        "nicco park": "nicco park", "babughat": "babughat",
-        "shyambazar": "shyambazar", "barrackpore": "barrackpore",
-        "belur": "belur math", "belur math": "belur math",
-        "dakshineswar": "dakshineswar", "sovabazar": "sovabazar",
-        "bhawanipur": "bhawanipur", "hazra": "hazra",
-        "lansdowne": "lansdowne", "ballygunge": "ballygunge",
-        "kasba": "kasba", "regent park": "regent park",
-        "maniktala": "maniktala", "belgachia": "belgachia",
-        "cossipore": "cossipore", "sodepur": "sodepur",
-        "naihati": "naihati", "chandannagar": "chandannagar",
-        "bally": "bally", "liluah": "liluah",
-        "belgharia": "belgharia", "madhyamgram": "madhyamgram",
-        "rajarhat": "rajarhat", "chinar park": "chinar park",
-        "baguiati": "baguiati", "phoolbagan": "phoolbagan",
-        "entally": "entally", "dharmatala": "dharmatala",
-        "maidan": "maidan", "nandan": "nandan",
-        "exide": "exide crossing", "rabindra sadan": "rabindra sadan",
-    }
-    if q in aliases:
-        alias_name = aliases[q]
-        for s in BUS_STOPS:
-            if s["name"].lower() == alias_name:
-                return s
-    # Partial match: check if query is contained in stop name
-    matches = []
-    for s in BUS_STOPS:
-        name_lower = s["name"].lower()
-        if q in name_lower:
-            matches.append(s)
-    if len(matches) == 1:
-        return matches[0]
-    if matches:
-        matches.sort(key=lambda s: len(s["name"]))
-        return matches[0]
-    # Word-start match
-    for s in BUS_STOPS:
-        words = s["name"].lower().split()
-        if any(w.startswith(q) for w in words):
-            return s
+    stop = _STOPS_BY_NAME.get(q) or _STOPS_BY_ID.get(q)
+    if stop:
+        return stop
+    if q in _STOP_ALIASES:
+        stop = _STOPS_BY_NAME.get(_STOP_ALIASES[q])
+        if stop:
+            return stop
+    # Partial match: shortest stop name containing the query. This also covers
+    # word-start matches, since a word starting with q means q is in the name.
+    if "\0" not in q:
+        pos = _STOP_NAME_BLOB.find(q)
+        if pos >= 0:
+            return _STOP_NAME_LOWER[bisect_right(_STOP_NAME_STARTS, pos) - 1][1]
+    # Typos: closest stop name or alias, if it is close enough
+    close = difflib.get_close_matches(q, _STOP_FUZZY_KEYS, n=1, cutoff=0.8)
+    if close:
+        return _STOPS_BY_NAME.get(close[0]) or _STOPS_BY_NAME.get(_STOP_ALIASES.get(close[0], ""))
     return None
 
+def _score_midstops(from_pos: int, to_pos: int) -> np.ndarray:
+    """Estimated minutes for a one-transfer trip via each stop, as an array
+    aligned with BUS_STOPS."""
+    via_km = _STOP_DIST_KM[from_pos] + _STOP_DIST_KM[to_pos]
+    return np.maximum(10, (via_km * 3.5).astype(np.int64) + 5)
+
 @app.get("/routes/find-route")
-def find_route_between(from_stop: str = Query(...), to_stop: str = Query(...)):
+def find_route_between(response: Response, from_stop: str = Query(...), to_stop: str = Query(...)):
     from_s = _match_stop(from_stop)
     to_s = _match_stop(to_stop)
     if not from_s or not to_s:
@@ -501,79 +898,80 @@ def find_route_between(from_stop: str = Query(...), to_stop: str = Query(...)):
         if not to_s:
             missing.append(to_stop)
         raise HTTPException(status_code=404, detail=f"Stop(s) not found: {', '.join(missing)}. Try using full stop names like 'Howrah Station', 'New Town', 'Esplanade', etc.")
-    
-    direct_routes = set(from_s.get("routes", [])) & set(to_s.get("routes", []))
-    results = []
-    for rid in direct_routes:
-        route = next((r for r in BUS_ROUTES if r["id"] == rid), None)
-        if route:
-            dist = math.sqrt((from_s["lat"]-to_s["lat"])**2 + (from_s["lng"]-to_s["lng"])**2) * 111
-            est_time = max(5, int(dist * 3.5))
-            results.append({
-                "type": "direct",
-                "route": route,
-                "from_stop": from_s["name"],
-                "to_stop": to_s["name"],
-                "estimated_time_min": est_time,
-                "estimated_fare": route.get("fare_min", 8),
-                "transfers": 0
-            })
-    
-    # If no direct route, find transfer routes (fastest first)
+    response.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}"
+    return _route_options(from_s.pos, to_s.pos)
+
+@lru_cache(maxsize=None)
+def _route_options(from_pos: int, to_pos: int) -> dict:
+    """Direct/transfer options between two stops. Deterministic per stop pair,
+    so cached; every spelling that resolves to the same pair shares an entry."""
+    from_s = _STOPS[from_pos]
+    to_s = _STOPS[to_pos]
+    results = [
+        {
+            "type": "direct",
+            "route": route,
+            "from_stop": from_s.name,
+            "to_stop": to_s.name,
+            "estimated_time_min": est_time,
+            "estimated_fare": est_fare,
+            "transfers": 0
+        } for route, est_time, est_fare in _DIRECT_ROUTES.get((from_pos, to_pos), ())
+    ]
+
+    # If no direct route, find transfer routes (fastest first). Only stops on
+    # one of from_s's routes can be a transfer point, so walk those via the
+    # route graph instead of testing every stop.
     if not results:
-        transfer_results = []
-        seen_transfers = set()
-        for mid_stop in BUS_STOPS:
-            if mid_stop["id"] == from_s["id"] or mid_stop["id"] == to_s["id"]:
-                continue
-            from_common = set(from_s.get("routes", [])) & set(mid_stop.get("routes", []))
-            to_common = set(mid_stop.get("routes", [])) & set(to_s.get("routes", []))
-            if from_common and to_common:
-                r1 = next((r for r in BUS_ROUTES if r["id"] == list(from_common)[0]), None)
-                r2 = next((r for r in BUS_ROUTES if r["id"] == list(to_common)[0]), None)
-                if r1 and r2:
-                    key = f"{r1['id']}-{mid_stop['id']}-{r2['id']}"
-                    if key in seen_transfers:
-                        continue
-                    seen_transfers.add(key)
-                    d1 = math.sqrt((from_s["lat"]-mid_stop["lat"])**2 + (from_s["lng"]-mid_stop["lng"])**2) * 111
-                    d2 = math.sqrt((mid_stop["lat"]-to_s["lat"])**2 + (mid_stop["lng"]-to_s["lng"])**2) * 111
-                    est_time = max(10, int((d1 + d2) * 3.5) + 5)
-                    transfer_results.append({
-                        "type": "transfer",
-                        "leg1_route": r1,
-                        "leg2_route": r2,
-                        "from_stop": from_s["name"],
-                        "transfer_stop": mid_stop["name"],
-                        "to_stop": to_s["name"],
-                        "estimated_time_min": est_time,
-                        "estimated_fare": r1.get("fare_min",8) + r2.get("fare_min",8),
-                        "transfers": 1
-                    })
-        transfer_results.sort(key=lambda x: x["estimated_time_min"])
-        results = transfer_results[:5]
+        candidates = {}  # BUS_STOPS position -> (leg1 route, leg2 route)
+        for r1_id in sorted(from_s.routes):
+            for mid_stop in _ROUTE_STOPS[r1_id]:
+                if mid_stop.pos in candidates or mid_stop.pos == from_pos or mid_stop.pos == to_pos:
+                    continue
+                to_common = mid_stop.routes & to_s.routes
+                if to_common:
+                    candidates[mid_stop.pos] = (_ROUTES_BY_ID[r1_id], _ROUTES_BY_ID[min(to_common)])
+        if candidates:
+            # Keep the 5 fastest candidates (ties in BUS_STOPS order)
+            est_times = _score_midstops(from_pos, to_pos)
+            for pos in heapq.nsmallest(5, candidates, key=lambda i: (est_times[i], i)):
+                r1, r2 = candidates[pos]
+                results.append({
+                    "type": "transfer",
+                    "leg1_route": r1,
+                    "leg2_route": r2,
+                    "from_stop": from_s.name,
+                    "transfer_stop": _STOPS[pos].name,
+                    "to_stop": to_s.name,
+                    "estimated_time_min": int(est_times[pos]),
+                    "estimated_fare": r1.get("fare_min",8) + r2.get("fare_min",8),
+                    "transfers": 1
+                })
     
-    results.sort(key=lambda x: (x["transfers"], x["estimated_time_min"]))
     return {
-        "results": results[:5],
-        "from": from_s["name"],
-        "to": to_s["name"],
-        "from_coords": {"lat": from_s["lat"], "lng": from_s["lng"]},
-        "to_coords": {"lat": to_s["lat"], "lng": to_s["lng"]}
+        "results": heapq.nsmallest(5, results, key=lambda x: (x["transfers"], x["estimated_time_min"])),
+        "from": from_s.name,
+        "to": to_s.name,
+        "from_coords": {"lat": from_s.lat, "lng": from_s.lng},
+        "to_coords": {"lat": to_s.lat, "lng": to_s.lng}
     }
 
 @app.get("/routes/search/{query}")
 def search_routes(query: str):
-    q = query.lower()
-    results = [r for r in BUS_ROUTES if q in r["name"].lower() or q in r["from"].lower() or q in r["to"].lower() or q in r.get("via", "").lower()]
-    return {"routes": results}
+    return {"routes": _search_routes(query.lower())}
+
+@lru_cache(maxsize=1024)
+def _search_routes(q: str) -> list:
+    if "\0" in q:  # would match across the field separators
+        return []
+    return [r for r, blob in _ROUTE_SEARCH_BLOBS if q in blob]
 
 @app.get("/routes/{route_id}")
 def get_route(route_id: str):
-    route = next((r for r in BUS_ROUTES if r["id"] == route_id), None)
+    route = _ROUTES_BY_ID.get(route_id)
     if not route:
         raise HTTPException(status_code=404, detail="Route not found")
-    stops = [s for s in BUS_STOPS if route_id in s.get("routes", [])]
+    stops = [BUS_STOPS[s.pos] for s in _ROUTE_STOPS[route_id]]
     return {"route": route, "stops": stops}
 
 # ── Bus Stops ────────────────────────────────────────────────────────
@@ -581,25 +979,49 @@ def get_route(route_id: str):
 def get_stops():
     return {"stops": BUS_STOPS}
 
+# Nearest-stop candidates are cached per ~110 m grid cell (lat/lng rounded to
+# 3 decimals), so clients panning the same map area share one tree query.
+NEAREST_GRID_DECIMALS = 3
+# No point is further than this from the rounded centre of its cell (half a
+# cell each way; a degree of longitude is never longer than one of latitude)
+_GRID_CELL_RADIUS_KM = math.radians(0.5 * 10 ** -NEAREST_GRID_DECIMALS) * EARTH_RADIUS_KM * math.sqrt(2)
+
+@lru_cache(maxsize=4096)
+def _nearest_in_cell(lat: float, lng: float, k: int) -> np.ndarray:
+    """BUS_STOPS positions, in list order, of every stop that can be one of
+    the k nearest to some point of the cell centred on (lat, lng); read-only.
+    A point within r of the centre has its k nearest stops within d_k + r of
+    itself, so within d_k + 2r of the centre."""
+    centre = np.radians([[lat, lng]])
+    dists, _ = _STOP_TREE.query(centre, k=k)
+    radius = dists[0, -1] + 2 * _GRID_CELL_RADIUS_KM / EARTH_RADIUS_KM
+    idx = np.sort(_STOP_TREE.query_radius(centre, r=radius)[0]).astype(np.intp)
+    idx.setflags(write=False)
+    return idx
+
 @app.get("/stops/nearest")
 def get_nearest_stops(lat: float = Query(...), lng: float = Query(...), limit: int = Query(5)):
-    def haversine(lat1, lon1, lat2, lon2):
-        R = 6371
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-        return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    
-    stops_with_dist = []
-    for s in BUS_STOPS:
-        dist = haversine(lat, lng, s["lat"], s["lng"])
-        stops_with_dist.append({**s, "distance_km": round(dist, 2), "distance_m": round(dist * 1000)})
-    stops_with_dist.sort(key=lambda x: x["distance_km"])
-    return {"stops": stops_with_dist[:limit], "user_location": {"lat": lat, "lng": lng}}
+    k = limit if 0 < limit <= len(_STOPS) else len(_STOPS)
+    idx = _nearest_in_cell(round(lat, NEAREST_GRID_DECIMALS), round(lng, NEAREST_GRID_DECIMALS), k)
+    # Candidates are ranked from the caller's exact position, ties in list order
+    dists = haversine_vec(lat, lng, _STOP_LATLNG_RAD[idx, 0], _STOP_LATLNG_RAD[idx, 1], _STOP_LATLNG_COS[idx])
+    # Out-of-range limits keep list-slice semantics over all stops
+    order = np.argsort(dists, kind="stable")[:limit]
+    stops = [{**BUS_STOPS[i], "distance_km": round(d, 2), "distance_m": round(d * 1000)}
+             for i, d in zip(idx[order].tolist(), dists[order].tolist())]
+    return {"stops": stops, "user_location": {"lat": lat, "lng": lng}}
 
 # ── _match_stop helper (used by find-route above) ───────────────────
 
 # ── ETA Prediction ──────────────────────────────────────────────────
+def eta_formula(distance_km: float, avg_speed: float, traffic_index: float, hour_of_day: int) -> float:
+    """Minutes to cover distance_km when no ML model is available: free-flow
+    time scaled up by traffic, plus a bump in the morning/evening peaks."""
+    traffic_multiplier = 1 + traffic_index * 0.8
+    if 8 <= hour_of_day <= 10 or 17 <= hour_of_day <= 20:
+        traffic_multiplier += 0.3
+    return distance_km / max(avg_speed, 1) * 60 * traffic_multiplier
+
 @app.get("/predict-eta")
 def predict_eta(
     distance_remaining: float = Query(...),
@@ -614,13 +1036,22 @@ def predict_eta(
         eta = eta_model.predict(features)
         return {"eta_minutes": round(float(eta[0]), 2), "source": "ml_model"}
     else:
-        base_eta = (distance_remaining / max(avg_speed, 1)) * 60
-        traffic_multiplier = 1 + (traffic_index * 0.8)
-        if 8 <= hour_of_day <= 10 or 17 <= hour_of_day <= 20:
-            traffic_multiplier += 0.3
-        return {"eta_minutes": round(base_eta * traffic_multiplier, 2), "source": "formula"}
+        return {"eta_minutes": round(eta_formula(distance_remaining, avg_speed, traffic_index, hour_of_day), 2), "source": "formula"}
 
 # ── Smart ETA (MVP) ─────────────────────────────────────────────────
+def _transfer_stop(from_s: Stop, to_s: Stop) -> Optional[Stop]:
+    """First stop in BUS_STOPS order, other than the two ends, where a route
+    through from_s meets a route through to_s."""
+    best = None
+    for ra in from_s.routes:
+        for rb in to_s.routes:
+            for pos in _ROUTE_ADJ.get((ra, rb), ()):
+                if pos != from_s.pos and pos != to_s.pos:
+                    if best is None or pos < best:
+                        best = pos
+                    break
+    return None if best is None else _STOPS[best]
+
 @app.get("/smart-eta")
 def smart_eta(
     user_lat: float = Query(...),
@@ -629,108 +1060,54 @@ def smart_eta(
     db: Session = Depends(get_db),
 ):
     """Core MVP endpoint: user GPS + destination → nearest stop + best bus + ETA"""
-    import math
-
-    def haversine(lat1, lon1, lat2, lon2):
-        R = 6371
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-        return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-
-    # 1. Find nearest bus stops to user (sorted by distance)
-    stops_by_dist = []
-    for s in BUS_STOPS:
-        dist = haversine(user_lat, user_lng, s["lat"], s["lng"])
-        stops_by_dist.append({**s, "distance_km": round(dist, 2)})
-    stops_by_dist.sort(key=lambda x: x["distance_km"])
-
-    # 2. Fuzzy-match destination to a bus stop
+    # 1. Find nearest bus stops to user (sorted by distance). Stops stay Stop
+    # records until the response is built; only the 8 closest are considered.
+    stops_by_dist = _nearest_stops(user_lat, user_lng, min(8, len(_STOPS)))
+
+    # 2. Fuzzy-match destination to a bus stop, the same way find-route does
     dest_lower = destination.strip().lower()
-    aliases = {
-        "howrah": "howrah station", "sealdah": "sealdah station",
-        "airport": "airport (nscbi)", "newtown": "new town city centre",
-        "new town": "new town city centre", "salt lake": "salt lake sector v",
-        "sector v": "salt lake sector v", "garia": "garia station",
-        "behala": "behala", "joka": "joka", "esplanade": "esplanade",
-        "jadavpur": "jadavpur", "dunlop": "dunlop", "tollygunge": "tollygunge",
-        "barasat": "barasat", "bbd bagh": "bbd bagh", "bbdbagh": "bbd bagh",
-        "karunamoyee": "karunamoyee", "science city": "science city",
-        "ruby": "ruby hospital", "park circus": "park circus",
-        "gariahat": "gariahat", "shyambazar": "shyambazar",
-        "nicco park": "nicco park", "babughat": "babughat",
-        "barrackpore": "barrackpore", "ultadanga": "ultadanga",
-        "dum dum": "dum dum", "moulali": "moulali",
-        "belur": "belur math", "belur math": "belur math",
-        "dakshineswar": "dakshineswar", "sovabazar": "sovabazar",
-        "bhawanipur": "bhawanipur", "hazra": "hazra",
-        "lansdowne": "lansdowne", "ballygunge": "ballygunge",
-        "kasba": "kasba", "regent park": "regent park",
-        "maniktala": "maniktala", "belgachia": "belgachia",
-        "cossipore": "cossipore", "sodepur": "sodepur",
-        "naihati": "naihati", "chandannagar": "chandannagar",
-        "bally": "bally", "liluah": "liluah",
-        "belgharia": "belgharia", "madhyamgram": "madhyamgram",
-        "rajarhat": "rajarhat", "chinar park": "chinar park",
-        "baguiati": "baguiati", "phoolbagan": "phoolbagan",
-        "entally": "entally", "dharmatala": "dharmatala",
-        "maidan": "maidan", "nandan": "nandan",
-        "exide": "exide crossing", "rabindra sadan": "rabindra sadan",
-    }
-    resolved = aliases.get(dest_lower, dest_lower)
-    dest_stop = None
-    for s in BUS_STOPS:
-        if resolved == s["name"].lower() or dest_lower in s["name"].lower() or s["name"].lower().startswith(dest_lower):
-            dest_stop = s
-            break
-    if not dest_stop:
+    dest_s = _match_stop(dest_lower)
+    if dest_s is None:
         # Try partial match
-        for s in BUS_STOPS:
-            if any(word in s["name"].lower() for word in dest_lower.split()):
-                dest_stop = s
-                break
-    if not dest_stop:
+        words = dest_lower.split()
+        dest_s = next((s for s, name in zip(_STOPS, _STOP_NAMES_IN_ORDER) if any(w in name for w in words)), None)
+    if dest_s is None:
         raise HTTPException(status_code=404, detail=f"Could not find destination '{destination}' in our bus stop database")
 
     # 3. Find a bus route that connects a nearby stop to the destination
     best_result = None
-    for nearby in stops_by_dist[:8]:  # Check 8 nearest stops
-        common_routes = set(nearby["routes"]) & set(dest_stop["routes"])
-        if common_routes and nearby["id"] != dest_stop["id"]:
-            route_id = list(common_routes)[0]
-            route = next((r for r in BUS_ROUTES if r["id"] == route_id), None)
-            if route:
-                # Calculate distance between the two stops
-                stop_distance = haversine(nearby["lat"], nearby["lng"], dest_stop["lat"], dest_stop["lng"])
-                best_result = {
-                    "pickup_stop": nearby,
-                    "route": route,
-                    "stop_distance_km": round(stop_distance, 2),
-                }
-                break
+    for nearby, nearby_km in stops_by_dist[:8]:  # Check 8 nearest stops
+        common_routes = nearby.routes & dest_s.routes
+        if common_routes and nearby.id != dest_s.id:
+            route = _ROUTES_BY_ID[min(common_routes)]
+            # Calculate distance between the two stops
+            stop_distance = _haversine_km(nearby.lat, nearby.lng, dest_s.lat, dest_s.lng)
+            best_result = {
+                "pickup_stop": nearby,
+                "pickup_distance_km": round(nearby_km, 2),
+                "route": route,
+                "stop_distance_km": round(stop_distance, 2),
+            }
+            break
 
     if not best_result:
         # Fallback: find a transfer route
-        for nearby in stops_by_dist[:5]:
-            for mid_stop in BUS_STOPS:
-                common1 = set(nearby["routes"]) & set(mid_stop["routes"])
-                common2 = set(mid_stop["routes"]) & set(dest_stop["routes"])
-                if common1 and common2 and nearby["id"] != mid_stop["id"] and mid_stop["id"] != dest_stop["id"]:
-                    r1 = next((r for r in BUS_ROUTES if r["id"] == list(common1)[0]), None)
-                    r2 = next((r for r in BUS_ROUTES if r["id"] == list(common2)[0]), None)
-                    if r1 and r2:
-                        d1 = haversine(nearby["lat"], nearby["lng"], mid_stop["lat"], mid_stop["lng"])
-                        d2 = haversine(mid_stop["lat"], mid_stop["lng"], dest_stop["lat"], dest_stop["lng"])
-                        best_result = {
-                            "pickup_stop": nearby,
-                            "route": r1,
-                            "transfer_stop": mid_stop,
-                            "transfer_route": r2,
-                            "stop_distance_km": round(d1 + d2, 2),
-                            "is_transfer": True,
-                        }
-                        break
-            if best_result:
+        for nearby, nearby_km in stops_by_dist[:5]:
+            mid_s = _transfer_stop(nearby, dest_s)
+            if mid_s:
+                r1 = _ROUTES_BY_ID[min(nearby.routes & mid_s.routes)]
+                r2 = _ROUTES_BY_ID[min(mid_s.routes & dest_s.routes)]
+                d1 = _haversine_km(nearby.lat, nearby.lng, mid_s.lat, mid_s.lng)
+                d2 = _haversine_km(mid_s.lat, mid_s.lng, dest_s.lat, dest_s.lng)
+                best_result = {
+                    "pickup_stop": nearby,
+                    "pickup_distance_km": round(nearby_km, 2),
+                    "route": r1,
+                    "transfer_stop": mid_s,
+                    "transfer_route": r2,
+                    "stop_distance_km": round(d1 + d2, 2),
+                    "is_transfer": True,
+                }
                 break
 
     if not best_result:
@@ -738,10 +1115,9 @@ def smart_eta(
 
     # 4. Auto-calculate traffic index from live bus speeds
     hour_of_day = datetime.now().hour
-    all_live = db.query(LiveBusDB).all()
-    if all_live and any(b.speed > 0 for b in all_live):
+    avg_live_speed, moving_buses = db.execute(MOVING_BUS_SPEED).one()
+    if moving_buses:
         # Calculate from real bus speeds: fast = low traffic, slow = high traffic
-        avg_live_speed = sum(b.speed for b in all_live if b.speed > 0) / max(len([b for b in all_live if b.speed > 0]), 1)
         # Map speed to traffic index: 40+ km/h = 0.1, 5 km/h = 1.0
         traffic_index = round(max(0.1, min(1.0, 1.0 - (avg_live_speed - 5) / 35)), 2)
         traffic_source = "live_speed"
@@ -759,41 +1135,40 @@ def smart_eta(
 
     # 5. Calculate ETA
     pickup = best_result["pickup_stop"]
-    walk_distance_km = pickup["distance_km"]
+    walk_distance_km = best_result["pickup_distance_km"]
     walk_time_min = round(walk_distance_km / 0.08, 1)  # ~5 km/h walking = 0.083 km/min
 
     stop_distance = best_result["stop_distance_km"]
     avg_speed = 22  # Average bus speed in Kolkata (km/h)
 
+    route = best_result["route"]
+
+    # Closest live bus on this route, found up front so its ETA to the pickup
+    # stop can go through the model in the same predict call
+    closest, bus_to_stop_dist = _closest_live_bus(db, route["id"], pickup.lat, pickup.lng)
+
     # Use ML or formula for bus travel ETA
     if eta_model:
         features = [[stop_distance, avg_speed, traffic_index, hour_of_day]]
-        bus_travel_min = round(float(eta_model.predict(features)[0]), 1)
+        if closest is not None:
+            features.append([bus_to_stop_dist, max(closest.speed, 15), traffic_index, hour_of_day])
+        predicted = [float(v) for v in eta_model.predict(features)]
+        bus_travel_min = round(predicted[0], 1)
         eta_source = "ml_model"
     else:
-        base_eta = (stop_distance / max(avg_speed, 1)) * 60
-        traffic_multiplier = 1 + (traffic_index * 0.8)
-        if 8 <= hour_of_day <= 10 or 17 <= hour_of_day <= 20:
-            traffic_multiplier += 0.3
-        bus_travel_min = round(base_eta * traffic_multiplier, 1)
+        bus_travel_min = round(eta_formula(stop_distance, avg_speed, traffic_index, hour_of_day), 1)
         eta_source = "formula"
 
     # Estimated wait time at bus stop (based on route frequency)
-    route = best_result["route"]
     wait_time_min = round(route["frequency_min"] / 2, 1)  # Average wait = half the frequency
 
     total_eta_min = round(walk_time_min + wait_time_min + bus_travel_min, 1)
 
     # 5. Check for live buses on this route
     live_bus = None
-    live_buses = db.query(LiveBusDB).filter(LiveBusDB.route_id == route["id"]).all()
-    if live_buses:
-        # Find the closest live bus
-        closest = min(live_buses, key=lambda b: haversine(b.latitude, b.longitude, pickup["lat"], pickup["lng"]))
-        bus_to_stop_dist = haversine(closest.latitude, closest.longitude, pickup["lat"], pickup["lng"])
+    if closest is not None:
         if eta_model:
-            live_eta_features = [[bus_to_stop_dist, max(closest.speed, 15), traffic_index, hour_of_day]]
-            live_eta = round(float(eta_model.predict(live_eta_features)[0]), 1)
+            live_eta = round(predicted[1], 1)
         else:
             live_eta = round((bus_to_stop_dist / max(closest.speed if closest.speed > 0 else 15, 1)) * 60 * (1 + traffic_index * 0.8), 1)
         live_bus = {
@@ -812,12 +1187,12 @@ def smart_eta(
     response = {
         "user_location": {"lat": user_lat, "lng": user_lng},
         "pickup_stop": {
-            "name": pickup["name"], "lat": pickup["lat"], "lng": pickup["lng"],
-            "distance_km": pickup["distance_km"],
+            "name": pickup.name, "lat": pickup.lat, "lng": pickup.lng,
+            "distance_km": walk_distance_km,
             "walk_time_min": walk_time_min,
         },
         "destination_stop": {
-            "name": dest_stop["name"], "lat": dest_stop["lat"], "lng": dest_stop["lng"],
+            "name": dest_s.name, "lat": dest_s.lat, "lng": dest_s.lng,
         },
         "bus_route": {
             "id": route["id"], "name": route["name"],
@@ -844,40 +1219,199 @@ def smart_eta(
         ts = best_result["transfer_stop"]
         tr = best_result["transfer_route"]
         response["transfer"] = {
-            "stop": {"name": ts["name"], "lat": ts["lat"], "lng": ts["lng"]},
+            "stop": {"name": ts.name, "lat": ts.lat, "lng": ts.lng},
             "route": {"id": tr["id"], "name": tr["name"], "from": tr["from"], "to": tr["to"]},
         }
-        response["bus_route"]["transfer_note"] = f"Change at {ts['name']} to {tr['name']}"
+        response["bus_route"]["transfer_note"] = f"Change at {ts.name} to {tr['name']}"
 
     return response
 
 
 # ── Live Bus Tracking ────────────────────────────────────────────────
-@app.post("/bus/update-location")
-def update_bus_location(req: LocationUpdate, db: Session = Depends(get_db)):
-    bus = db.query(LiveBusDB).filter(LiveBusDB.bus_reg == req.bus_reg).first()
-    if bus:
-        bus.latitude = req.latitude
-        bus.longitude = req.longitude
-        bus.speed = req.speed
-        bus.route_id = req.route_id or bus.route_id
-        bus.last_update = datetime.utcnow()
-    else:
-        bus = LiveBusDB(
-            bus_reg=req.bus_reg,
-            driver_id="",
-            latitude=req.latitude,
-            longitude=req.longitude,
-            speed=req.speed,
-            route_id=req.route_id,
+# Hot reads as module-level lambda statements: SQLAlchemy caches their compiled
+# SQL against the lambda's code, so a request only binds parameters instead of
+# building and compiling a fresh ORM query.
+ALL_LIVE_BUSES = lambda_stmt(lambda: select(LiveBusDB))
+MOVING_BUS_SPEED = lambda_stmt(lambda: select(func.avg(LiveBusDB.speed), func.count()).where(LiveBusDB.speed > 0))
+
+# Radius of the R*Tree box searched first for the closest bus on a route
+LIVE_BUS_SEARCH_KM = 5.0
+
+def _closest_of(buses: List[LiveBusDB], lat: float, lng: float) -> Tuple[Optional[LiveBusDB], float]:
+    if not buses:
+        return None, math.inf
+    dists = haversine_vec(lat, lng, np.radians([b.latitude for b in buses]), np.radians([b.longitude for b in buses]))
+    i = int(np.argmin(dists))
+    return buses[i], float(dists[i])
+
+def _closest_live_bus(db: Session, route_id: str, lat: float, lng: float) -> Tuple[Optional[LiveBusDB], float]:
+    """(bus, distance_km) for the live bus on route_id closest to (lat, lng),
+    or (None, inf). With the R*Tree only buses inside a LIVE_BUS_SEARCH_KM box
+    are loaded; the whole route is read only if none of them is that close."""
+    query = (
+        db.query(LiveBusDB)
+        .options(load_only(LiveBusDB.latitude, LiveBusDB.longitude, LiveBusDB.speed,
+                           LiveBusDB.crowd_level, LiveBusDB.status))
+        .filter(LiveBusDB.route_id == route_id)
+        .order_by(LiveBusDB.bus_reg)
+    )
+    if LIVE_RTREE:
+        dlat = math.degrees(LIVE_BUS_SEARCH_KM / EARTH_RADIUS_KM)
+        dlng = dlat / math.cos(math.radians(min(abs(lat) + dlat, 89.0)))
+        in_box = select(live_buses_rtree.c.id).where(
+            live_buses_rtree.c.max_lat >= lat - dlat, live_buses_rtree.c.min_lat <= lat + dlat,
+            live_buses_rtree.c.max_lng >= lng - dlng, live_buses_rtree.c.min_lng <= lng + dlng,
         )
-        db.add(bus)
+        bus, dist = _closest_of(query.filter(literal_column("live_buses.rowid").in_(in_box)).all(), lat, lng)
+        # Anything outside the box is further than LIVE_BUS_SEARCH_KM
+        if dist <= LIVE_BUS_SEARCH_KM:
+            return bus, dist
+    return _closest_of(query.all(), lat, lng)
+
+# GPS pings arrive every few seconds per bus and only the latest one matters,
+# so they are buffered in memory and written back in one batch every
+# LIVE_FLUSH_INTERVAL seconds rather than one SQLite transaction per ping.
+# Readers of live_buses see positions at most that far behind, and a bus whose
+# first ping is still buffered reads as not found until the flush.
+#
+# Every worker keeps its own buffer, so the upsert only moves a bus's position
+# forward in time, and pings received before the bus's last end-trip are dropped.
+LIVE_FLUSH_INTERVAL = 2.0
+_pending_pings = {}  # bus_reg -> (LocationUpdate, received_at)
+_live_write_lock = asyncio.Lock()
+
+def upsert_bus_locations(db: Session, pings: List[Tuple[LocationUpdate, datetime]]):
+    """Write (ping, received_at) pairs for any number of buses as one
+    executemany upsert and a single commit."""
+    if not pings:
+        return
+    rows = [
+        {
+            "bus_reg": u.bus_reg, "driver_id": "", "latitude": u.latitude,
+            "longitude": u.longitude, "speed": u.speed, "route_id": u.route_id,
+            "last_update": received_at, "position_at": received_at,
+        } for u, received_at in pings
+    ]
+    stmt = sqlite_insert(LiveBusDB)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[LiveBusDB.bus_reg],
+        set_={
+            "latitude": stmt.excluded.latitude,
+            "longitude": stmt.excluded.longitude,
+            "speed": stmt.excluded.speed,
+            # An empty route_id in a ping keeps the bus on its current route,
+            # and so does one received before the current trip started
+            "route_id": case(
+                (stmt.excluded.last_update > LiveBusDB.trip_started_at,
+                 func.coalesce(func.nullif(stmt.excluded.route_id, ""), LiveBusDB.route_id)),
+                else_=LiveBusDB.route_id,
+            ),
+            "last_update": func.max(LiveBusDB.last_update, stmt.excluded.last_update),
+            "position_at": stmt.excluded.position_at,
+        },
+        where=or_(LiveBusDB.position_at.is_(None), stmt.excluded.position_at > LiveBusDB.position_at),
+    )
+    db.execute(stmt, rows)
+    # A trip ended (by any worker) after a ping was received stays ended
+    db.execute(
+        delete(LiveBusDB)
+        .where(LiveBusDB.bus_reg.in_({u.bus_reg for u, _ in pings}))
+        .where(exists().where(EndedTripDB.bus_reg == LiveBusDB.bus_reg,
+                              EndedTripDB.ended_at >= LiveBusDB.last_update))
+        .execution_options(synchronize_session=False)
+    )
     db.commit()
+
+def _write_pings(pings: List[Tuple[LocationUpdate, datetime]]):
+    db = SessionLocal()
+    try:
+        upsert_bus_locations(db, pings)
+    finally:
+        db.close()
+
+async def _write_or_requeue(pings: List[Tuple[LocationUpdate, datetime]]):
+    """Write pings taken out of the buffer; if the write fails, put them back
+    behind any newer ping that arrived for the same bus in the meantime."""
+    try:
+        await run_in_threadpool(_write_pings, pings)
+    except BaseException:  # including cancellation at shutdown
+        for ping, received_at in pings:
+            newer = _pending_pings.get(ping.bus_reg)
+            if newer is None:
+                _pending_pings[ping.bus_reg] = (ping, received_at)
+            elif not newer[0].route_id and ping.route_id:
+                _pending_pings[ping.bus_reg] = (newer[0].copy(update={"route_id": ping.route_id}), newer[1])
+        raise
+
+async def flush_pending_pings():
+    """Write buffered pings to SQLite. The buffer swap happens on the event
+    loop, so it can't race with update_bus_location."""
+    async with _live_write_lock:
+        if not _pending_pings:
+            return
+        pings = list(_pending_pings.values())
+        _pending_pings.clear()
+        await _write_or_requeue(pings)
+
+async def _flush_bus_ping(bus_reg: str):
+    """Write bus_reg's buffered ping now. The caller holds _live_write_lock."""
+    ping = _pending_pings.pop(bus_reg, None)
+    if ping:
+        await _write_or_requeue([ping])
+
+async def _flush_pings_periodically():
+    while True:
+        await asyncio.sleep(LIVE_FLUSH_INTERVAL)
+        try:
+            await flush_pending_pings()
+        except Exception:
+            logger.exception("Live bus flush failed; pings kept for the next one")
+
+@app.on_event("startup")
+async def start_ping_flusher():
+    app.state.ping_flusher = asyncio.create_task(_flush_pings_periodically())
+
+@app.on_event("shutdown")
+async def stop_ping_flusher():
+    flusher = app.state.ping_flusher
+    flusher.cancel()
+    # Let a flush cut short by the cancel requeue its batch before the last one
+    try:
+        await flusher
+    except asyncio.CancelledError:
+        pass
+    await flush_pending_pings()
+
+def _buffer_ping(req: LocationUpdate, received_at: datetime):
+    prev = _pending_pings.get(req.bus_reg)
+    if prev and not req.route_id:
+        # Don't let a route-less ping drop a route set earlier in this window
+        req = req.copy(update={"route_id": prev[0].route_id})
+    _pending_pings[req.bus_reg] = (req, received_at)
+
+@app.post("/bus/update-location")
+async def update_bus_location(req: LocationUpdate):
+    _buffer_ping(req, datetime.utcnow())
     return {"status": "ok", "bus_reg": req.bus_reg}
 
+@app.post("/bus/update-locations-bulk")
+async def update_bus_locations_bulk(reqs: List[LocationUpdate]):
+    """Pings for many buses in one request (e.g. from a depot gateway); they
+    join the same buffer and go out in the next batched upsert."""
+    received_at = datetime.utcnow()
+    for req in reqs:
+        _buffer_ping(req, received_at)
+    return {"status": "ok", "count": len(reqs)}
+
 @app.post("/bus/update-passengers")
-def update_passengers(req: PassengerCountUpdate, db: Session = Depends(get_db)):
-    bus = db.query(LiveBusDB).filter(LiveBusDB.bus_reg == req.bus_reg).first()
+async def update_passengers(req: PassengerCountUpdate, db: Session = Depends(get_db)):
+    async with _live_write_lock:
+        # A bus known only from a buffered ping must exist before it's updated
+        await _flush_bus_ping(req.bus_reg)
+    return await run_in_threadpool(_update_passengers, req, db)
+
+def _update_passengers(req: PassengerCountUpdate, db: Session):
+    bus = db.get(LiveBusDB, req.bus_reg)
     if not bus:
         raise HTTPException(status_code=404, detail="Bus not found")
     bus.passenger_count = req.passenger_count
@@ -892,8 +1426,13 @@ def update_passengers(req: PassengerCountUpdate, db: Session = Depends(get_db)):
     return {"status": "ok", "crowd_level": bus.crowd_level, "passenger_count": bus.passenger_count}
 
 @app.post("/bus/update-status")
-def update_bus_status(req: StatusUpdate, db: Session = Depends(get_db)):
-    bus = db.query(LiveBusDB).filter(LiveBusDB.bus_reg == req.bus_reg).first()
+async def update_bus_status(req: StatusUpdate, db: Session = Depends(get_db)):
+    async with _live_write_lock:
+        await _flush_bus_ping(req.bus_reg)
+    return await run_in_threadpool(_update_bus_status, req, db)
+
+def _update_bus_status(req: StatusUpdate, db: Session):
+    bus = db.get(LiveBusDB, req.bus_reg)
     if not bus:
         raise HTTPException(status_code=404, detail="Bus not found")
     bus.status = req.status
@@ -903,8 +1442,17 @@ def update_bus_status(req: StatusUpdate, db: Session = Depends(get_db)):
     return {"status": "ok", "bus_status": bus.status}
 
 @app.post("/bus/start-trip")
-def start_trip(req: TripStartRequest, db: Session = Depends(get_db)):
-    existing = db.query(LiveBusDB).filter(LiveBusDB.bus_reg == req.bus_reg).first()
+async def start_trip(req: TripStartRequest, db: Session = Depends(get_db)):
+    async with _live_write_lock:
+        # Write the buffered position first, so it can't land afterwards and
+        # replace the route and timestamps the new trip sets
+        await _flush_bus_ping(req.bus_reg)
+        await run_in_threadpool(_start_trip, req, db)
+    return {"status": "trip_started", "bus_reg": req.bus_reg}
+
+def _start_trip(req: TripStartRequest, db: Session):
+    db.query(EndedTripDB).filter(EndedTripDB.bus_reg == req.bus_reg).delete()
+    existing = db.get(LiveBusDB, req.bus_reg)
     if existing:
         existing.status = "running"
         existing.route_id = req.route_id
@@ -922,33 +1470,49 @@ def start_trip(req: TripStartRequest, db: Session = Depends(get_db)):
         )
         db.add(bus)
     db.commit()
-    return {"status": "trip_started", "bus_reg": req.bus_reg}
 
-@app.post("/bus/end-trip")
-def end_trip(bus_reg: str = Query(...), db: Session = Depends(get_db)):
-    bus = db.query(LiveBusDB).filter(LiveBusDB.bus_reg == bus_reg).first()
+def _delete_bus(bus_reg: str, db: Session):
+    ended = db.get(EndedTripDB, bus_reg)
+    if ended:
+        ended.ended_at = datetime.utcnow()
+    else:
+        db.add(EndedTripDB(bus_reg=bus_reg))
+    bus = db.get(LiveBusDB, bus_reg)
     if bus:
         db.delete(bus)
-        db.commit()
+    db.commit()
+
+@app.post("/bus/end-trip")
+async def end_trip(bus_reg: str = Query(...), db: Session = Depends(get_db)):
+    async with _live_write_lock:
+        # Drop this worker's buffered ping; the end-trip record covers the
+        # pings other workers still hold
+        _pending_pings.pop(bus_reg, None)
+        await run_in_threadpool(_delete_bus, bus_reg, db)
     return {"status": "trip_ended", "bus_reg": bus_reg}
 
 @app.get("/bus/live")
 def get_live_buses(db: Session = Depends(get_db)):
-    buses = db.query(LiveBusDB).all()
-    return {"buses": [
-        {
+    buses = db.execute(ALL_LIVE_BUSES).scalars().all()
+    live = []
+    for b in buses:
+        route_name, route_info = _ROUTE_LABELS.get(b.route_id, (b.route_id, ""))
+        live.append({
             "bus_reg": b.bus_reg, "route_id": b.route_id, "latitude": b.latitude,
             "longitude": b.longitude, "speed": b.speed, "passenger_count": b.passenger_count,
             "crowd_level": b.crowd_level, "status": b.status, "delay_reason": b.delay_reason,
-            "route_name": next((r["name"] for r in BUS_ROUTES if r["id"] == b.route_id), b.route_id),
-            "route_info": next((f"{r['from']} → {r['to']}" for r in BUS_ROUTES if r["id"] == b.route_id), ""),
-            "last_update": b.last_update.isoformat() if b.last_update else None,
-        } for b in buses
-    ]}
+            "route_name": route_name,
+            "route_info": route_info,
+            "last_update": b.last_update,
+        })
+    # Encoded straight to bytes, skipping FastAPI's jsonable_encoder pass over
+    # every bus; orjson writes the naive-UTC timestamps as ISO 8601 with "Z".
+    return Response(orjson.dumps({"buses": live}, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z),
+                    media_type="application/json")
 
 @app.get("/bus/{bus_reg}")
 def get_bus(bus_reg: str, db: Session = Depends(get_db)):
-    bus = db.query(LiveBusDB).filter(LiveBusDB.bus_reg == bus_reg.upper()).first()
+    bus = db.get(LiveBusDB, bus_reg.upper())
     if not bus:
         raise HTTPException(status_code=404, detail="Bus not found or trip ended")
     return {
@@ -960,15 +1524,15 @@ def get_bus(bus_reg: str, db: Session = Depends(get_db)):
 # ── Crowd Levels ─────────────────────────────────────────────────────
 @app.get("/crowd-levels")
 def get_crowd_levels(db: Session = Depends(get_db)):
-    buses = db.query(LiveBusDB).all()
+    buses = db.execute(ALL_LIVE_BUSES).scalars().all()
     levels = []
     for b in buses:
-        route = next((r for r in BUS_ROUTES if r["id"] == b.route_id), None)
+        route_name, route_info = _ROUTE_LABELS.get(b.route_id, (b.route_id, ""))
         levels.append({
             "bus_reg": b.bus_reg,
             "route_id": b.route_id,
-            "route_name": route["name"] if route else b.route_id,
-            "route_info": f"{route['from']} → {route['to']}" if route else "",
+            "route_name": route_name,
+            "route_info": route_info,
             "passenger_count": b.passenger_count,
             "crowd_level": b.crowd_level,
             "status": b.status,
@@ -976,6 +1540,10 @@ def get_crowd_levels(db: Session = Depends(get_db)):
     return {"crowd_data": levels}
 
 # ── Tickets ──────────────────────────────────────────────────────────
+USER_TICKETS = lambda_stmt(
+    lambda: select(TicketDB).where(TicketDB.user_id == bindparam("user_id")).order_by(TicketDB.booked_at.desc())
+)
+
 @app.post("/tickets")
 def book_ticket(req: TicketBookRequest, token: str = Query(...), db: Session = Depends(get_db)):
     user = decode_token(token)
@@ -1004,7 +1572,7 @@ def book_ticket(req: TicketBookRequest, token: str = Query(...), db: Session = D
 @app.get("/tickets")
 def get_tickets(token: str = Query(...), db: Session = Depends(get_db)):
     user = decode_token(token)
-    tickets = db.query(TicketDB).filter(TicketDB.user_id == user["user_id"]).order_by(TicketDB.booked_at.desc()).all()
+    tickets = db.execute(USER_TICKETS, {"user_id": user["user_id"]}).scalars().all()
     return {"tickets": [
         {
             "id": t.id, "route_id": t.route_id, "route_name": t.route_name,
@@ -1014,6 +1582,10 @@ def get_tickets(token: str = Query(...), db: Session = Depends(get_db)):
     ]}
 
 # ── Saved Routes ─────────────────────────────────────────────────────
+USER_SAVED_ROUTES = lambda_stmt(
+    lambda: select(SavedRouteDB).where(SavedRouteDB.user_id == bindparam("user_id")).order_by(SavedRouteDB.created_at.desc())
+)
+
 @app.post("/saved-routes")
 def save_route(req: SaveRouteRequest, token: str = Query(...), db: Session = Depends(get_db)):
     user = decode_token(token)
@@ -1026,7 +1598,7 @@ def save_route(req: SaveRouteRequest, token: str = Query(...), db: Session = Dep
 @app.get("/saved-routes")
 def get_saved_routes(token: str = Query(...), db: Session = Depends(get_db)):
     user = decode_token(token)
-    routes = db.query(SavedRouteDB).filter(SavedRouteDB.user_id == user["user_id"]).order_by(SavedRouteDB.created_at.desc()).all()
+    routes = db.execute(USER_SAVED_ROUTES, {"user_id": user["user_id"]}).scalars().all()
     return {"saved_routes": [
         {"id": r.id, "name": r.name, "from_place": r.from_place, "to_place": r.to_place, "created_at": r.created_at.isoformat()} for r in routes
     ]}
@@ -1046,4 +1618,6 @@ if __name__ == "__main__":
     import uvicorn
     host = os.getenv("HOST", "127.0.0.1")
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("app:app", host=host, port=port, reload=True)
+    # uvloop has no Windows build; fall back to the stock asyncio loop there.
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    uvicorn.run("app:app", host=host, port=port, reload=True, loop=loop, http="httptools")
@@ -15,11 +15,12 @@ data = {
 df = pd.DataFrame(data)
 
 # Features & target
-X = df[['distance_remaining_km', 'avg_speed', 'traffiio0ukljc_index', 'hour_of_day']]
+X = df[['distance_remaining_km', 'avg_speed', 'traffic_index', 'hour_of_day']]
 y = df['eta_minutes']
 
-# Train model
-model = RandomForestRegressor(n_estimators=100, random_state=42)
+# Train model. Five rows don't support 100 trees; 20 give the same fit and
+# keep each prediction (walked per request in app.py) short.
+model = RandomForestRegressor(n_estimators=20, random_state=42)
 model.fit(X, y)
 
 # Save model